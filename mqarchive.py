@@ -0,0 +1,356 @@
+import gzip
+import logging
+import os
+import queue
+import re
+import shutil
+import socket
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class ArchiveWriter(object):
+    """write messages to rotating, gzip compressed mbox or Maildir archives
+
+    Messages are handed to a background thread, which writes them in
+    batches. archive() never blocks: if the writer falls behind and its
+    queue is full, the message is dropped from the archive and counted
+    in self.dropped. Messages are bytes, or binary files which the
+    writer reads from and closes, so messages spooled to disk don't
+    have to be read into memory. Each queued file holds a file
+    descriptor and disk space, so at most max_files of them are queued
+    at once, further ones are dropped.
+
+    mbox archives are written to one gzip file per rotation period.
+    Maildir archives get one Maildir per rotation period, holding one
+    gzip compressed file per message.
+    """
+
+    FORMATS = ('mbox', 'maildir')
+
+    def __init__(self, path, archive_format='mbox', rotate_interval=86400,
+            max_bytes=None, batch_size=100, max_queue=10000, max_files=64):
+
+        if archive_format not in self.FORMATS:
+            raise Exception("bad value: archive_format should be one of {0}"
+                    .format(self.FORMATS))
+
+        self._path = path
+        self._format = archive_format
+        self._rotate_interval = rotate_interval
+        self._max_bytes = max_bytes
+        self._batch_size = batch_size
+
+        self._queue = queue.Queue(max_queue)
+        self._max_files = max_files
+        self._queued_files = 0
+        self._thread = None
+
+        # current archive file or Maildir
+        self._current = None
+        self._opened = None
+        self._written = 0
+        self._mbox = None
+        self._counter = 0
+
+        # dropped is counted from the publishing thread and the writer
+        self.archived = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+        # set when stop() runs out of time
+        self._abandon = threading.Event()
+
+        self._started = False
+
+
+    def archive(self, msg_bytes, sender=None):
+        """queue a message to be archived, without blocking"""
+
+        if hasattr(msg_bytes, 'read'):
+            with self._lock:
+                too_many = self._queued_files >= self._max_files
+                if not too_many:
+                    self._queued_files += 1
+            if too_many:
+                close_message(msg_bytes)
+                self.count_dropped(1)
+                log.warning("too many archive files queued, dropping message")
+                return
+
+        try:
+            self._queue.put_nowait((msg_bytes, sender, time.time()))
+        except queue.Full:
+            self.release(msg_bytes)
+            self.count_dropped(1)
+            log.warning("archive queue full, dropping message")
+
+
+    def release(self, msg_bytes):
+        """close a message that is done with, or that is not archived"""
+
+        if hasattr(msg_bytes, 'read'):
+            close_message(msg_bytes)
+            with self._lock:
+                self._queued_files -= 1
+
+
+    def count_dropped(self, count):
+
+        with self._lock:
+            self.dropped += count
+
+
+    def start(self):
+
+        os.makedirs(self._path, exist_ok=True)
+
+        self._thread = threading.Thread(target=self.write_messages)
+        self._thread.daemon = True
+        self._thread.start()
+
+        self._started = True
+
+
+    def stop(self, timeout=None):
+        """write out queued messages and close the archive
+
+        Waits up to timeout seconds, or for as long as it takes when
+        timeout is None. Messages still queued after the timeout are
+        discarded, the batch being written is finished in the
+        background. Returns the number of discarded messages.
+        """
+
+        if self._started is not True:
+            return 0
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        # None tells the thread to finish up
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+
+        remaining = None if deadline is None \
+                else max(0, deadline - time.monotonic())
+        self._thread.join(remaining)
+
+        unarchived = 0
+        if self._thread.is_alive():
+            self._abandon.set()
+
+            # take the queued messages away from the writer
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self.release(item[0])
+                    unarchived += 1
+
+            # wake the writer up, in case it is waiting for messages
+            self._queue.put_nowait(None)
+
+            log.warning("archive not flushed in time, {0} messages "
+                    "not archived".format(unarchived))
+
+        self._thread = None
+
+        self._started = False
+
+        return unarchived
+
+
+    def write_messages(self):
+        """write queued messages in batches, in a separate thread"""
+
+        stopping = False
+
+        while stopping is False and not self._abandon.is_set():
+
+            # wait for the first message, then take whatever else
+            # is already queued, up to the batch size
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+
+            try:
+                self.write_batch(batch)
+            except Exception:
+                log.exception("failed to archive {0} messages"
+                        .format(len(batch)))
+                self.count_dropped(len(batch))
+            else:
+                self.archived += len(batch)
+
+        self.close()
+
+        log.debug("leaving archive thread")
+
+
+    def write_batch(self, batch):
+
+        if not batch:
+            return
+
+        try:
+            self.rotate()
+
+            self._written += sum(message_size(item[0]) for item in batch)
+
+            if self._format == 'mbox':
+                self.write_mbox(batch)
+            else:
+                for msg_bytes, sender, received in batch:
+                    self.write_maildir(msg_bytes)
+        finally:
+            for item in batch:
+                self.release(item[0])
+
+
+    def rotate(self):
+        """start a new archive when the current one is too old or too big"""
+
+        now = time.time()
+
+        if self._current is not None:
+            too_old = self._rotate_interval is not None \
+                    and now - self._opened >= self._rotate_interval
+            too_big = self._max_bytes is not None \
+                    and self._written >= self._max_bytes
+            if not too_old and not too_big:
+                return
+            self.close()
+
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+        name = 'archive-{0}'.format(stamp)
+
+        # don't clobber an archive started in the same second
+        suffix = 0
+        while os.path.exists(self.archive_path(name, suffix)):
+            suffix += 1
+        self._current = self.archive_path(name, suffix)
+
+        log.debug("opening archive {0}".format(self._current))
+
+        if self._format == 'mbox':
+            self._mbox = gzip.open(self._current, 'ab')
+        else:
+            for subdir in ('tmp', 'new', 'cur'):
+                os.makedirs(os.path.join(self._current, subdir))
+
+        self._opened = now
+        self._written = 0
+
+
+    def archive_path(self, name, suffix):
+
+        if suffix:
+            name = '{0}.{1}'.format(name, suffix)
+
+        if self._format == 'mbox':
+            name += '.mbox.gz'
+
+        return os.path.join(self._path, name)
+
+
+    def close(self):
+
+        if self._mbox is not None:
+            self._mbox.close()
+            self._mbox = None
+
+        self._current = None
+
+
+    def write_mbox(self, batch):
+
+        # messages in memory are joined into one write,
+        # spooled messages are streamed line by line
+        entries = []
+
+        for msg_bytes, sender, received in batch:
+
+            from_line = 'From {0} {1}\n'.format(sender or 'MAILER-DAEMON',
+                    time.asctime(time.gmtime(received))).encode()
+
+            if not hasattr(msg_bytes, 'read'):
+                entries.append(self.mbox_entry(from_line, msg_bytes))
+                continue
+
+            self._mbox.write(b''.join(entries))
+            entries = []
+
+            self._mbox.write(from_line)
+            line = b'\n'
+            for line in msg_bytes:
+                line = self.mbox_quote(line)
+                self._mbox.write(line)
+            if not line.endswith(b'\n'):
+                self._mbox.write(b'\n')
+            self._mbox.write(b'\n')
+
+        self._mbox.write(b''.join(entries))
+        self._mbox.flush()
+
+
+    @staticmethod
+    def mbox_quote(msg_bytes):
+
+        # mboxrd style: normalize line endings and quote lines that
+        # start with From, or with From already quoted by any number
+        # of >, so the quoting can be reversed
+        msg_bytes = bytes(msg_bytes).replace(b'\r\n', b'\n')
+        return re.sub(rb'^(>*From )', rb'>\1', msg_bytes, flags=re.M)
+
+
+    @classmethod
+    def mbox_entry(cls, from_line, msg_bytes):
+
+        msg_bytes = cls.mbox_quote(msg_bytes)
+        if not msg_bytes.endswith(b'\n'):
+            msg_bytes += b'\n'
+
+        return from_line + msg_bytes + b'\n'
+
+
+    def write_maildir(self, msg_bytes):
+
+        self._counter += 1
+        name = '{0:.6f}.P{1}Q{2}.{3}.gz'.format(time.time(), os.getpid(),
+                self._counter, socket.gethostname().replace('/', '_'))
+
+        # write to tmp, then move to new, as the Maildir spec asks
+        tmp_path = os.path.join(self._current, 'tmp', name)
+        with gzip.open(tmp_path, 'wb') as f:
+            if hasattr(msg_bytes, 'read'):
+                shutil.copyfileobj(msg_bytes, f)
+            else:
+                f.write(msg_bytes)
+        os.rename(tmp_path, os.path.join(self._current, 'new', name))
+
+
+def message_size(msg_bytes):
+
+    if hasattr(msg_bytes, 'read'):
+        return os.fstat(msg_bytes.fileno()).st_size
+
+    return len(msg_bytes)
+
+
+def close_message(msg_bytes):
+
+    if hasattr(msg_bytes, 'read'):
+        msg_bytes.close()
@@ -2,6 +2,11 @@ import zmq
 import threading
 import queue
 import logging
+import re
+
+from email.parser import BytesHeaderParser
+
+from mqenvelope import StructuredMessage, decode_value, have_msgpack
 
 
 log = logging.getLogger(__name__)
@@ -9,7 +14,8 @@ log = logging.getLogger(__name__)
 
 class MailQueueClient(object):
 
-    def __init__(self, queue_host="mail-server", queue_port=5563, filter_pattern=""):
+    def __init__(self, queue_host="mail-server", queue_port=5563, filter_pattern="",
+            structured=False):
         self._context = None
         self._subscriber = None
         self._queue_host = None
@@ -21,6 +27,9 @@ class MailQueueClient(object):
         self.queue_port = queue_port
         self.filter_pattern = filter_pattern
 
+        # store StructuredMessage objects instead of bytes
+        self.structured = structured
+
         self.messages = queue.Queue()
 
         self._stop_event = None
@@ -72,16 +81,34 @@ class MailQueueClient(object):
             if self._subscriber in socks and socks[self._subscriber] == zmq.POLLIN:
                 # Read envelope with address
                 log.debug("waiting on subscriber to receive message")
-                [rcpttos,data] = self._subscriber.recv_multipart()
+                # servers using the structured publish format
+                # send a third frame describing the message
+                frames = self._subscriber.recv_multipart()
 
-                log.debug("received message: %s" % (data))
-                self.messages.put(data)
+                # one bad message shouldn't stop the thread
+                try:
+                    rcpttos, data = frames[0], frames[1]
+                    meta = frames[2] if len(frames) > 2 else None
 
-                log.debug("Message count: %i" % (self.messages.qsize()))
+                    log.debug("received message: %s" % (data))
+                    self.handle_message(rcpttos, data, meta)
+                except Exception:
+                    log.exception("failed to handle message")
 
         log.debug("leaving thread")
 
 
+    def handle_message(self, rcpttos, data, meta=None):
+        """store a message received from the subscriber"""
+
+        if self.structured:
+            data = StructuredMessage.from_frames(data, meta)
+
+        self.messages.put(data)
+
+        log.debug("Message count: %i" % (self.messages.qsize()))
+
+
     def start(self):
         log.debug("starting subscriber thread")
 
@@ -131,3 +158,149 @@ class MailQueueClient(object):
         log.debug("finished terminating subscriber thread")
 
         self._started = False
+
+
+class MessageMatcher(object):
+    """route messages to rules, compiled from a list of rules
+
+    Rules are looked up through an exact recipient map and a domain map,
+    so the cost of matching does not grow with the number of mailboxes.
+    Header regular expressions are only evaluated for the rules that
+    already matched on address, and the headers are parsed at most once
+    per message.
+    """
+
+    def __init__(self, rules):
+
+        self._recipients = {}
+        self._domains = {}
+        self._any_address = []
+        self._headers = {}
+
+        for name, rule in rules.items():
+
+            if not rule['recipients'] and not rule['domains']:
+                self._any_address.append(name)
+
+            for recipient in rule['recipients']:
+                self._recipients.setdefault(recipient, []).append(name)
+
+            for domain in rule['domains']:
+                self._domains.setdefault(domain, []).append(name)
+
+            if rule['headers']:
+                self._headers[name] = rule['headers']
+
+        self._parser = BytesHeaderParser()
+
+
+    def match(self, rcpttos, data, headers=None):
+        """return the names of the rules that match a message
+
+        headers : decoded (name, value) pairs of the message, if the
+                  server already parsed them
+        """
+
+        names = set(self._any_address)
+
+        for rcptto in rcpttos.decode().split(','):
+            rcptto = rcptto.strip().lower()
+            names.update(self._recipients.get(rcptto, ()))
+            names.update(self._domains.get(rcptto.rpartition('@')[2], ()))
+
+        lookup = None
+
+        for name in [n for n in names if n in self._headers]:
+
+            if lookup is None:
+                # decode the values the way the server does for the
+                # structured publish format, so rules match the same
+                if headers is None:
+                    headers = [(header, decode_value(value)) for header, value
+                                in self._parser.parsebytes(data).items()]
+                lookup = {}
+                for header, value in headers:
+                    lookup.setdefault(header.lower(), value)
+
+            for header, pattern in self._headers[name]:
+                value = lookup.get(header)
+                if value is None or pattern.search(value) is None:
+                    names.discard(name)
+                    break
+
+        return names
+
+
+class MultiplexedMailQueueClient(MailQueueClient):
+    """one subscriber routing messages into many filtered queues
+
+    Instead of starting one MailQueueClient per mailbox, add a rule
+    per mailbox. Each rule gets its own queue in self.queues.
+    """
+
+    def __init__(self, queue_host="mail-server", queue_port=5563,
+            structured=False):
+
+        super().__init__(queue_host, queue_port, structured=structured)
+
+        self.queues = {}
+
+        self._rules = {}
+        self._matcher = MessageMatcher(self._rules)
+
+
+    def add_rule(self, name, recipients=(), domains=(), headers=None):
+        """add a routing rule and return the queue it delivers to
+
+        name : name of the rule, and key of its queue in self.queues
+        recipients : list of recipient email addresses to match exactly
+        domains : list of recipient domains to match
+        headers : dict of header names to regular expressions that
+                  must all match
+
+        A rule with no recipients and no domains matches all addresses.
+        """
+
+        if name in self._rules:
+            raise Exception("bad value: rule {0} already exists".format(name))
+
+        self._rules[name] = {
+            'recipients' : [r.lower() for r in recipients],
+            'domains' : [d.lower() for d in domains],
+            'headers' : [(h.lower(), re.compile(p))
+                            for h, p in (headers or {}).items()],
+        }
+
+        self.queues[name] = queue.Queue()
+
+        # rebuild the matcher, the subscriber thread picks up
+        # the new one on the next message
+        self._matcher = MessageMatcher(self._rules)
+
+        return self.queues[name]
+
+
+    def remove_rule(self, name):
+
+        del self._rules[name]
+        self._matcher = MessageMatcher(self._rules)
+        del self.queues[name]
+
+
+    def handle_message(self, rcpttos, data, meta=None):
+        """store a message in the queue of each matching rule"""
+
+        queues = self.queues
+
+        # use the headers the server already decoded, if it sent them
+        headers = None
+        if (meta is not None and have_msgpack()) or self.structured:
+            message = StructuredMessage.from_frames(data, meta)
+            headers = message.headers
+            if self.structured:
+                data = message
+
+        for name in self._matcher.match(rcpttos, data, headers):
+            q = queues.get(name)
+            if q is not None:
+                q.put(data)
@@ -0,0 +1,263 @@
+import binascii
+import re
+
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# end of a header block, the first empty line
+HEADER_END = re.compile(rb'\r?\n\r?\n')
+
+# an empty header block, the message starts with an empty line
+NO_HEADERS = re.compile(rb'\r?\n')
+
+# line breaks in folded header values
+FOLDING = re.compile(r'\r?\n(?=[ \t])')
+
+
+def check_msgpack():
+
+    if msgpack is None:
+        raise Exception("msgpack is required for the structured publish format")
+
+
+def have_msgpack():
+
+    return msgpack is not None
+
+
+def decode_value(value):
+    """unfold a header value and decode its RFC 2047 encoded words"""
+
+    value = FOLDING.sub('', str(value))
+
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def find_header_end(raw, start, end):
+    """return (header_end, body_start) of the part starting at start"""
+
+    m = NO_HEADERS.match(raw, start, end)
+    if m is not None:
+        return start, m.end()
+
+    m = HEADER_END.search(raw, start, end)
+    if m is None:
+        return end, end
+
+    return m.start(), m.end()
+
+
+def scan_part(raw, start, end, path, parts, parser):
+    """add the part between start and end, and its subparts, to parts"""
+
+    header_end, body_start = find_header_end(raw, start, end)
+    headers = parser.parsebytes(bytes(raw[start:header_end]))
+
+    part = {
+        'path' : path,
+        'content_type' : headers.get_content_type(),
+        'charset' : headers.get_content_charset(),
+        'filename' : headers.get_filename(),
+        'disposition' : headers.get_content_disposition(),
+        'transfer_encoding' :
+            str(headers.get('Content-Transfer-Encoding', '7bit')).lower(),
+        'start' : start,
+        'body_start' : body_start,
+        'end' : end,
+    }
+    if part['filename'] is not None:
+        part['filename'] = decode_value(part['filename'])
+
+    parts.append(part)
+
+    boundary = headers.get_boundary()
+    if headers.get_content_maintype() != 'multipart' or not boundary:
+        return headers
+
+    # delimiter lines start with --boundary, the closing one ends
+    # with an extra --. The line break before a delimiter belongs
+    # to the delimiter, not to the part before it.
+    delimiter = re.compile(rb'(\r?\n)?--' + re.escape(boundary.encode())
+            + rb'(--)?[ \t]*(\r?\n|\Z)')
+
+    child_start = None
+    index = 0
+    pos = body_start
+
+    while True:
+
+        m = delimiter.search(raw, pos, end)
+        if m is None:
+            break
+
+        pos = m.end()
+
+        # delimiters must start a line
+        if m.group(1) is None and m.start() != body_start:
+            continue
+
+        if child_start is not None:
+            index += 1
+            scan_part(raw, child_start, m.start(),
+                    '{0}.{1}'.format(path, index) if path else str(index),
+                    parts, parser)
+
+        if m.group(2) is not None:
+            break
+
+        child_start = m.end()
+
+    return headers
+
+
+def last_header(headers, name):
+
+    values = headers.get_all(name)
+    return str(values[-1]) if values else None
+
+
+def describe(raw, peer=None, mail_from=None, rcpt_tos=None):
+    """describe a message, for the structured publish format
+
+    Returns a dict holding the envelope (peer, mail_from and rcpt_tos),
+    the decoded top level headers and a table of MIME parts. The server
+    passes in the envelope of the SMTP session. Otherwise it is taken
+    from the last X-Peer, X-MailFrom and X-RcptTo headers, the ones the
+    server added after any the sender wrote. Each part records the
+    byte offsets of its headers (start), its body (body_start) and its
+    end in raw, so consumers can slice parts out of the raw message
+    without parsing it. Only header blocks are parsed, raw may be any
+    bytes like object, including a memory map.
+    """
+
+    parts = []
+    headers = scan_part(raw, 0, len(raw), '', parts, BytesHeaderParser())
+
+    if peer is None:
+        peer = last_header(headers, 'X-Peer')
+
+    if mail_from is None:
+        mail_from = last_header(headers, 'X-MailFrom')
+
+    if rcpt_tos is None:
+        rcpt_tos = last_header(headers, 'X-RcptTo')
+        rcpt_tos = rcpt_tos.split(', ') if rcpt_tos else []
+
+    return {
+        'peer' : peer,
+        'mail_from' : mail_from,
+        'rcpt_tos' : list(rcpt_tos),
+        'headers' : [[name, decode_value(value)]
+                        for name, value in headers.items()],
+        'parts' : parts,
+    }
+
+
+def pack(raw, peer=None, mail_from=None, rcpt_tos=None):
+
+    check_msgpack()
+
+    return msgpack.packb(describe(raw, peer, mail_from, rcpt_tos),
+            use_bin_type=True)
+
+
+def unpack(data):
+
+    check_msgpack()
+
+    return msgpack.unpackb(data, raw=False)
+
+
+class StructuredMessage(object):
+    """a received message with its pre-parsed envelope, headers and parts"""
+
+    def __init__(self, raw, envelope=None):
+
+        self.raw = raw
+
+        # messages published in the raw format are described
+        # on the client side instead
+        if envelope is None:
+            envelope = describe(raw)
+
+        self.envelope = envelope
+
+
+    @classmethod
+    def from_frames(cls, raw, meta):
+
+        # without msgpack, describe the message here instead
+        if meta is None or not have_msgpack():
+            return cls(raw)
+
+        return cls(raw, unpack(meta))
+
+
+    @property
+    def peer(self):
+        return self.envelope['peer']
+
+
+    @property
+    def mail_from(self):
+        return self.envelope['mail_from']
+
+
+    @property
+    def rcpt_tos(self):
+        return self.envelope['rcpt_tos']
+
+
+    @property
+    def headers(self):
+        return self.envelope['headers']
+
+
+    @property
+    def parts(self):
+        return self.envelope['parts']
+
+
+    def header(self, name, default=None):
+        """return the first decoded value of a header"""
+
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+
+    def attachments(self):
+
+        return [part for part in self.parts if part['filename'] is not None]
+
+
+    def part_bytes(self, part):
+        """return the still encoded body of a part, without copying it"""
+
+        return memoryview(self.raw)[part['body_start']:part['end']]
+
+
+    def part_payload(self, part):
+        """return the body of a part with its transfer encoding removed"""
+
+        body = bytes(self.part_bytes(part))
+        encoding = part['transfer_encoding']
+
+        if encoding == 'base64':
+            return binascii.a2b_base64(body)
+
+        if encoding == 'quoted-printable':
+            return binascii.a2b_qp(body)
+
+        return body
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+import logging
+import struct
+import time
+import zmq
+
+
+log = logging.getLogger(__name__)
+
+
+# capture file layout:
+#   the MAGIC bytes, followed by one record per published message.
+#   each record is a RECORD_HEADER, holding the time since the first
+#   message in nanoseconds and the number of frames, followed by a
+#   FRAME_HEADER, holding the frame length, and the bytes of each frame.
+
+MAGIC = b'MQCAP1\n'
+RECORD_HEADER = struct.Struct('<QH')
+FRAME_HEADER = struct.Struct('<I')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    record_parser = subparsers.add_parser("record",
+                        help="record the publish stream of a mail queue")
+
+    record_parser.add_argument("--mail-queue-host",
+                        help="message queue host",
+                        default="127.0.0.1",
+                        type=str)
+
+    record_parser.add_argument("--mail-queue-port",
+                        help="message queue port",
+                        default=5563,
+                        type=int)
+
+    record_parser.add_argument("--filter-pattern",
+                        help="only record messages matching this prefix",
+                        default="",
+                        type=str)
+
+    record_parser.add_argument("--count",
+                        help="stop after recording this many messages",
+                        default=None,
+                        type=int)
+
+    record_parser.add_argument("--duration",
+                        help="stop after recording this many seconds",
+                        default=None,
+                        type=float)
+
+    record_parser.add_argument("--hwm",
+                        help="receive high water mark, 0 means unlimited",
+                        default=0,
+                        type=int)
+
+    record_parser.add_argument("capture",
+                        help="capture file, gzip compressed if it ends in .gz",
+                        type=str)
+
+    replay_parser = subparsers.add_parser("replay",
+                        help="replay a capture onto a publish socket")
+
+    replay_parser.add_argument("--mail-queue-host",
+                        help="message queue host",
+                        default="*",
+                        type=str)
+
+    replay_parser.add_argument("--mail-queue-port",
+                        help="message queue port",
+                        default=5563,
+                        type=int)
+
+    replay_parser.add_argument("--speed",
+                        help="replay speed multiplier, 0 means "
+                             "as fast as possible",
+                        default=1.0,
+                        type=float)
+
+    replay_parser.add_argument("--wait",
+                        help="seconds to wait for subscribers to connect "
+                             "before replaying",
+                        default=1.0,
+                        type=float)
+
+    replay_parser.add_argument("--hwm",
+                        help="send high water mark, 0 means unlimited",
+                        default=0,
+                        type=int)
+
+    replay_parser.add_argument("capture",
+                        help="capture file, gzip compressed if it ends in .gz",
+                        type=str)
+
+    opts = parser.parse_args()
+    return opts
+
+
+def open_capture(path, mode):
+
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+
+    return open(path, mode)
+
+
+def make_subscriber(context, queue_uri, filter_pattern=b"", hwm=0):
+    """connect a SUB socket for recording
+
+    hwm is the receive high water mark, the default of 0 queues every
+    message instead of dropping them when the recorder falls behind.
+    """
+
+    subscriber = context.socket(zmq.SUB)
+    subscriber.setsockopt(zmq.RCVHWM, hwm)
+    subscriber.connect(queue_uri)
+    subscriber.setsockopt(zmq.SUBSCRIBE, filter_pattern)
+
+    return subscriber
+
+
+def make_publisher(context, queue_uri, hwm=0):
+    """bind a PUB socket for replaying
+
+    hwm is the send high water mark, the default of 0 queues every
+    message for slow subscribers instead of dropping them.
+    """
+
+    publisher = context.socket(zmq.PUB)
+    publisher.setsockopt(zmq.SNDHWM, hwm)
+    publisher.bind(queue_uri)
+
+    return publisher
+
+
+def write_record(f, offset, frames):
+    """write one message, received offset nanoseconds into the capture"""
+
+    f.write(RECORD_HEADER.pack(offset, len(frames)))
+    for frame in frames:
+        f.write(FRAME_HEADER.pack(len(frame)))
+        f.write(frame)
+
+
+def read_records(f):
+    """yield (offset, frames) for each message in a capture
+
+    A record cut short at the end of the capture, e.g. when recording
+    was interrupted while writing it, is skipped.
+    """
+
+    if f.read(len(MAGIC)) != MAGIC:
+        raise Exception("bad value: not a mail queue capture file")
+
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if not header:
+            return
+
+        if len(header) < RECORD_HEADER.size:
+            log.warning("skipping truncated record at end of capture")
+            return
+
+        offset, nframes = RECORD_HEADER.unpack(header)
+
+        frames = []
+        for i in range(nframes):
+            frame_header = f.read(FRAME_HEADER.size)
+            if len(frame_header) < FRAME_HEADER.size:
+                log.warning("skipping truncated record at end of capture")
+                return
+
+            (length,) = FRAME_HEADER.unpack(frame_header)
+            frame = f.read(length)
+            if len(frame) < length:
+                log.warning("skipping truncated record at end of capture")
+                return
+
+            frames.append(frame)
+
+        yield offset, frames
+
+
+def record(subscriber, f, count=None, duration=None, stop_event=None):
+    """record messages from a subscriber socket into a capture file
+
+    Recording stops after count messages, after duration seconds or
+    when stop_event is set, whichever happens first. Returns the number
+    of messages recorded.
+    """
+
+    f.write(MAGIC)
+
+    poller = zmq.Poller()
+    poller.register(subscriber, zmq.POLLIN)
+
+    started = time.monotonic()
+    first = None
+    recorded = 0
+
+    while count is None or recorded < count:
+
+        if stop_event is not None and stop_event.is_set():
+            break
+
+        timeout = 500
+        if duration is not None:
+            remaining = started + duration - time.monotonic()
+            if remaining <= 0:
+                break
+            timeout = min(timeout, remaining * 1000)
+
+        if not poller.poll(timeout):
+            continue
+
+        frames = subscriber.recv_multipart()
+        now = time.monotonic_ns()
+        if first is None:
+            first = now
+
+        write_record(f, now - first, frames)
+        recorded += 1
+
+        log.debug("recorded message {0}".format(recorded))
+
+    return recorded
+
+
+def replay(publisher, f, speed=1.0):
+    """replay a capture file onto a publisher socket
+
+    speed scales the recorded timing, 2.0 replays twice as fast.
+    A speed of 0 sends every message as fast as possible.
+    Returns the number of messages handed to the publisher. PUB sockets
+    still drop messages for subscribers that are not connected yet, and
+    for slow subscribers once the send high water mark is reached, so
+    use a publisher from make_publisher(), which doesn't limit it.
+    """
+
+    started = time.monotonic()
+    sent = 0
+
+    for offset, frames in read_records(f):
+
+        if speed > 0:
+            delay = started + offset / 1e9 / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        publisher.send_multipart(frames)
+        sent += 1
+
+    log.debug("replayed {0} messages in {1:.3f} seconds".format(
+        sent, time.monotonic() - started))
+
+    return sent
+
+
+def main(opts):
+
+    context = zmq.Context()
+
+    # term() waits for open sockets, destroy() closes them first.
+    # queued messages are only delivered when nothing went wrong,
+    # otherwise they are discarded so main() returns right away
+    linger = 0
+
+    try:
+        if opts.command == "record":
+            subscriber = make_subscriber(context, "tcp://{0}:{1}".format(
+                opts.mail_queue_host, opts.mail_queue_port),
+                opts.filter_pattern.encode(), opts.hwm)
+
+            with open_capture(opts.capture, 'wb') as f:
+                try:
+                    record(subscriber, f, opts.count, opts.duration)
+                except KeyboardInterrupt:
+                    pass
+
+            linger = None
+
+        else:
+            publisher = make_publisher(context, "tcp://{0}:{1}".format(
+                opts.mail_queue_host, opts.mail_queue_port), opts.hwm)
+
+            try:
+                # give subscribers a chance to connect,
+                # PUB sockets drop messages nobody is subscribed to
+                time.sleep(opts.wait)
+
+                with open_capture(opts.capture, 'rb') as f:
+                    replay(publisher, f, opts.speed)
+            except KeyboardInterrupt:
+                pass
+            else:
+                linger = None
+    finally:
+        context.destroy(linger)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    main(parse_arguments())
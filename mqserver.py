@@ -2,17 +2,36 @@
 
 import argparse
 import asyncio
+import collections
+import concurrent.futures
 import logging
+import mmap
+import os
+import re
+import tempfile
+import time
 import zmq
 import zmq.asyncio
 
 from aiosmtpd.controller import Controller
 from aiosmtpd.handlers import AsyncMessage
+from email.parser import BytesHeaderParser
+from email.utils import COMMASPACE
+
+import mqenvelope
+
+from mqarchive import ArchiveWriter
 
 
 log = logging.getLogger(__name__)
 
 
+PUBLISH_FORMATS = ('raw', 'structured')
+
+# messages up to this size are described on the event loop
+PACK_INLINE_SIZE = 64 * 1024
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
 
@@ -36,16 +55,250 @@ def parse_arguments():
                         default=1025,
                         type=int)
 
+    parser.add_argument("--peer-rate",
+                        help="messages per second accepted from each peer",
+                        default=None,
+                        type=float)
+
+    parser.add_argument("--peer-burst",
+                        help="burst size allowed for each peer",
+                        default=None,
+                        type=int)
+
+    parser.add_argument("--sender-rate",
+                        help="messages per second accepted from each sender",
+                        default=None,
+                        type=float)
+
+    parser.add_argument("--sender-burst",
+                        help="burst size allowed for each sender",
+                        default=None,
+                        type=int)
+
+    parser.add_argument("--max-message-size",
+                        help="largest message accepted, in bytes",
+                        default=None,
+                        type=int)
+
+    parser.add_argument("--spool-threshold",
+                        help="messages larger than this many bytes are "
+                             "spooled to disk instead of parsed in memory",
+                        default=None,
+                        type=int)
+
+    parser.add_argument("--spool-dir",
+                        help="directory for spooled messages",
+                        default=None,
+                        type=str)
+
+    parser.add_argument("--publish-format",
+                        help="raw publishes [recipients, message], "
+                             "structured adds a msgpack frame with the "
+                             "envelope, headers and MIME part offsets",
+                        default="raw",
+                        choices=PUBLISH_FORMATS,
+                        type=str)
+
+    parser.add_argument("--shutdown-timeout",
+                        help="seconds to wait for in flight messages "
+                             "to be published when shutting down",
+                        default=10,
+                        type=float)
+
+    parser.add_argument("--archive-path",
+                        help="directory to archive accepted messages in",
+                        default=None,
+                        type=str)
+
+    parser.add_argument("--archive-format",
+                        help="archive format",
+                        default="mbox",
+                        choices=ArchiveWriter.FORMATS,
+                        type=str)
+
+    parser.add_argument("--archive-rotate",
+                        help="seconds before starting a new archive",
+                        default=86400,
+                        type=int)
+
     opts = parser.parse_args()
     return opts
 
 
-class ZeroMQHandler(AsyncMessage):
+class TokenBucket(object):
+    """token bucket refilled at rate tokens per second, holding up to burst"""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+
+
+    def available(self, tokens=1):
+        """refill the bucket, return True if it holds enough tokens"""
+
+        now = self._clock()
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+
+        return self._tokens >= tokens
 
-    def __init__(self, publisher, debug_queue=None, message_class=None):
+
+    def consume(self, tokens=1):
+        """take tokens from the bucket, return False if there are not enough"""
+
+        if not self.available(tokens):
+            return False
+
+        self._tokens -= tokens
+        return True
+
+
+class RateLimiter(object):
+    """one token bucket per key, e.g. per peer or per sender address"""
+
+    def __init__(self, rate, burst=None, max_keys=10000, clock=time.monotonic):
+
+        if rate <= 0:
+            raise ValueError("bad value: rate should be positive")
+
+        if burst is not None and burst < 1:
+            raise ValueError("bad value: burst should be at least 1")
+
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._clock = clock
+
+        # least recently used buckets are evicted first, so memory
+        # stays bounded when many distinct keys show up
+        self._max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+
+
+    def bucket(self, key):
+
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, self._clock)
+        self._buckets[key] = bucket
+
+        while len(self._buckets) > self._max_keys:
+            self._buckets.popitem(last=False)
+
+        return bucket
+
+
+    def allow(self, key):
+
+        return self.bucket(key).consume()
+
+
+class FairPublisher(object):
+    """publish messages round robin across senders
+
+    Each sender gets its own pending queue. A single drain task sends
+    one message from each sender in turn, so when the publisher falls
+    behind, a sender with a large backlog does not hold up the others.
+    """
+
+    def __init__(self, publisher):
 
         self._publisher = publisher
+        self._pending = collections.OrderedDict()
+        self._task = None
+
+
+    @property
+    def backlog(self):
+
+        return sum(len(items) for items in self._pending.values())
+
+
+    async def send_multipart(self, frames, sender=None):
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        self._pending.setdefault(sender, collections.deque()).append(
+                (frames, future))
+
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._drain())
+
+        await future
+
+
+    async def _drain(self):
+
+        while self._pending:
+
+            # take one message from the sender at the front of the line,
+            # then move that sender to the back
+            sender, items = self._pending.popitem(last=False)
+            frames, future = items.popleft()
+            if items:
+                self._pending[sender] = items
+
+            try:
+                await self._publisher.send_multipart(frames)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(None)
+
+
+# a carriage return that doesn't start a CRLF
+LONE_CR = re.compile(rb'\r(?!\n)')
+
+
+def write_spool(f, headers, body, chunk_size=1 << 20):
+    """write a message to a spool file, changing line endings to LF
+
+    Like as_bytes(), CRLF and lone CR line endings both become LF.
+    """
+
+    f.write(headers)
+
+    # a CRLF split across two chunks is put back together
+    carry = b''
+    for i in range(0, len(body), chunk_size):
+        chunk = carry + bytes(body[i:i + chunk_size])
+        carry = b''
+        if chunk.endswith(b'\r'):
+            chunk, carry = chunk[:-1], b'\r'
+        f.write(chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n'))
+    f.write(carry.replace(b'\r', b'\n'))
+
+    f.flush()
+
+
+class ZeroMQHandler(AsyncMessage):
+
+    def __init__(self, publisher, debug_queue=None, message_class=None,
+            peer_limiter=None, sender_limiter=None,
+            spool_threshold=None, spool_dir=None, archive=None,
+            structured=False):
+
+        self._publisher = FairPublisher(publisher)
+        self._structured = structured
         self._debug_queue = debug_queue
+        self._archive = archive
+        self._peer_limiter = peer_limiter
+        self._sender_limiter = sender_limiter
+        self._spool_threshold = spool_threshold
+        self._spool_dir = spool_dir
+
+        # track messages being handled, so stop() can wait for them
+        self.in_flight = 0
+        self.published = 0
+        self._draining = False
+        self._idle = None
 
         super().__init__(message_class)
 
@@ -57,14 +310,131 @@ class ZeroMQHandler(AsyncMessage):
         log.debug('Message addressed to  : {0}'.format(envelope.rcpt_tos))
         log.debug('Message length        : {0}'.format(len(envelope.content)))
 
-        return await super().handle_DATA(server, session, envelope)
+        if self._draining:
+            return '421 4.3.2 Service shutting down, try again later'
+
+        # temp-fail clients that send faster than their limit,
+        # they are expected to retry later. session.peer is a
+        # (host, port) tuple, the port changes on every connection.
+        peer = session.peer[0] if isinstance(session.peer, tuple) \
+                else session.peer
+
+        buckets = []
+
+        if self._peer_limiter is not None:
+            bucket = self._peer_limiter.bucket(peer)
+            if not bucket.available():
+                log.info('Rate limit exceeded for peer: {0}'.format(peer))
+                return '451 4.7.1 Peer rate limit exceeded, try again later'
+            buckets.append(bucket)
+
+        if self._sender_limiter is not None:
+            bucket = self._sender_limiter.bucket(envelope.mail_from)
+            if not bucket.available():
+                log.info('Rate limit exceeded for sender: {0}'.format(
+                    envelope.mail_from))
+                return '451 4.7.1 Sender rate limit exceeded, try again later'
+            buckets.append(bucket)
 
+        # only take tokens once the message passed every limit,
+        # so rejected messages don't use up the peer's budget
+        for bucket in buckets:
+            bucket.consume()
 
-    async def handle_message(self, message):
+        self.in_flight += 1
 
-        # message is an email.message.Message object
+        try:
+            if self._spool_threshold is not None \
+                    and len(envelope.original_content) > self._spool_threshold:
+                if await self.handle_large_message(session, envelope):
+                    return '250 OK'
+
+            # publish with the SMTP envelope, rather than the X-MailFrom
+            # and X-RcptTo headers, which the sender could have forged
+            message = self.prepare_message(session, envelope)
+            await self.handle_message(message, envelope, session)
+            return '250 OK'
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0 and self._idle is not None:
+                self._idle.set()
+
+
+    async def drain(self, timeout):
+        """stop accepting messages and wait for in flight messages
+
+        Returns the number of messages still in flight after waiting
+        up to timeout seconds.
+        """
+
+        self._draining = True
+
+        if self.in_flight > 0:
+            self._idle = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        return self.in_flight
+
+
+    async def handle_large_message(self, session, envelope):
+        """publish a large message without parsing its body
+
+        Parsing the message and serializing it again with as_bytes()
+        keeps several copies of the message in memory at once. Instead,
+        only the header block is parsed, to add the X-Peer, X-MailFrom
+        and X-RcptTo headers the way prepare_message() does. The headers
+        and the body, with its line endings changed to LF the way
+        as_bytes() would, are written to a temporary file, which is
+        published from a memory map.
+
+        Returns False, without publishing, when the header block can't
+        be serialized the same way as the parsed message would be, so
+        the caller can fall back to parsing it.
+        """
+
+        tos = COMMASPACE.join(envelope.rcpt_tos)
+        raw = envelope.original_content
+
+        header_end, body_start = mqenvelope.find_header_end(raw, 0, len(raw))
+        header_block = raw[:header_end]
+        headers = BytesHeaderParser(self.message_class).parsebytes(
+                header_block)
+
+        # malformed header lines end up in the payload, and lone CRs
+        # change where the parser thinks the header block ends
+        if headers.defects or headers.get_payload() \
+                or LONE_CR.search(header_block):
+            log.debug('Malformed header block, parsing the message instead')
+            return False
 
-        log.debug('message = {0}'.format(message.as_bytes()))
+        headers['X-Peer'] = str(session.peer)
+        headers['X-MailFrom'] = envelope.mail_from
+        headers['X-RcptTo'] = tos
+
+        log.debug('Spooling message to disk: {0} bytes'.format(len(raw)))
+
+        loop = asyncio.get_running_loop()
+
+        with tempfile.TemporaryFile(dir=self._spool_dir) as f:
+
+            # don't block the event loop on disk writes
+            await loop.run_in_executor(None, write_spool, f,
+                    headers.as_bytes(), memoryview(raw)[body_start:])
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as msg_bytes:
+                await self.publish(tos.encode(), msg_bytes, envelope.mail_from,
+                        spool=f, peer=str(session.peer),
+                        rcpt_tos=envelope.rcpt_tos)
+
+        return True
+
+
+    async def handle_message(self, message, envelope=None, session=None):
+
+        # message is an email.message.Message object
 
         # Use message enveloping pattern so we can filter messages
         # on the client side. This approach has a flaw in that if
@@ -76,21 +446,91 @@ class ZeroMQHandler(AsyncMessage):
         # use cases, emails sent through the system will probably only
         # be sent to one recipient.
 
-        tos = message['X-RcptTo'].encode()
+        # the headers can be forged by the sender, so the SMTP
+        # envelope is used when there is one
+        peer = rcpt_tos = None
+        if envelope is not None:
+            tos = COMMASPACE.join(envelope.rcpt_tos)
+            sender = envelope.mail_from
+            rcpt_tos = envelope.rcpt_tos
+        else:
+            # prepare_message() appends its headers after any
+            # the sender wrote, so use the last ones
+            tos = message.get_all('X-RcptTo')[-1]
+            sender = message.get_all('X-MailFrom')[-1]
+
+        if session is not None:
+            peer = str(session.peer)
+
         msg_bytes = message.as_bytes()
-        await self._publisher.send_multipart([tos, msg_bytes])
 
+        log.debug('message = %s', msg_bytes)
+
+        await self.publish(tos.encode(), msg_bytes, sender,
+                peer=peer, rcpt_tos=rcpt_tos)
+
+
+    async def publish(self, tos, msg_bytes, sender, spool=None,
+            peer=None, rcpt_tos=None):
+
+        frames = [tos, msg_bytes]
+
+        # describe the message once here, so subscribers
+        # don't each have to parse it again. Describing a large
+        # message scans all of it, so that happens off the event loop.
+        if self._structured:
+            if len(msg_bytes) > PACK_INLINE_SIZE:
+                loop = asyncio.get_running_loop()
+                frames.append(await loop.run_in_executor(None,
+                    mqenvelope.pack, msg_bytes, peer, sender, rcpt_tos))
+            else:
+                frames.append(mqenvelope.pack(msg_bytes, peer, sender,
+                    rcpt_tos))
+
+        await self._publisher.send_multipart(frames, sender=sender)
+        self.published += 1
+
+        # the message is already published, so failing to archive it
+        # must not fail the SMTP transaction, or the client would retry
+        if self._archive is not None:
+            try:
+                if spool is not None:
+                    # archive spooled messages from their own handle on the
+                    # spool file, instead of copying them onto the heap
+                    archived = os.fdopen(os.dup(spool.fileno()), 'rb')
+                    archived.seek(0)
+                    self._archive.archive(archived, sender)
+                else:
+                    self._archive.archive(msg_bytes, sender)
+            except Exception:
+                log.exception('Failed to archive message')
+                self._archive.count_dropped(1)
+
+        # the debug queue is for tests, spooled messages are copied
         if self._debug_queue is not None:
-            await self._debug_queue.put(msg_bytes)
+            await self._debug_queue.put(bytes(msg_bytes))
 
 
 class MailQueueServer(object):
 
-    def __init__(self, queue_host, queue_port, mail_host, mail_port):
+    def __init__(self, queue_host, queue_port, mail_host, mail_port,
+            peer_rate=None, peer_burst=None,
+            sender_rate=None, sender_burst=None,
+            max_message_size=None, spool_threshold=None, spool_dir=None,
+            archive_path=None, archive_format='mbox', archive_rotate=86400,
+            publish_format='raw'):
+
+        if publish_format not in PUBLISH_FORMATS:
+            raise Exception("bad value: publish_format should be one of {0}"
+                    .format(PUBLISH_FORMATS))
+
+        if publish_format == 'structured':
+            mqenvelope.check_msgpack()
 
         # message queue variables
         self._queue_host = queue_host
         self._queue_port = queue_port
+        self._publish_format = publish_format
         self.context = None
         self.publisher = None
 
@@ -100,6 +540,23 @@ class MailQueueServer(object):
         self.handler = None
         self.controller = None
 
+        # rate limits, None means unlimited
+        self._peer_rate = peer_rate
+        self._peer_burst = peer_burst
+        self._sender_rate = sender_rate
+        self._sender_burst = sender_burst
+
+        # large message handling, None means use the defaults
+        self._max_message_size = max_message_size
+        self._spool_threshold = spool_threshold
+        self._spool_dir = spool_dir
+
+        # archive of accepted messages, None means don't archive
+        self._archive_path = archive_path
+        self._archive_format = archive_format
+        self._archive_rotate = archive_rotate
+        self.archive = None
+
         # store emails for debugging
         self._store_emails = False
         self.queue = None
@@ -132,15 +589,83 @@ class MailQueueServer(object):
         if self.store_emails is True and self.queue is None:
             self.queue = asyncio.Queue()
 
+        # setup the rate limiters
+        peer_limiter = None
+        if self._peer_rate is not None:
+            peer_limiter = RateLimiter(self._peer_rate, self._peer_burst)
+
+        sender_limiter = None
+        if self._sender_rate is not None:
+            sender_limiter = RateLimiter(self._sender_rate, self._sender_burst)
+
+        # setup the archive writer
+        if self._archive_path is not None:
+            self.archive = ArchiveWriter(self._archive_path,
+                    self._archive_format, self._archive_rotate)
+            self.archive.start()
+
         # Prepare the mail server handler and controller
-        self.handler = ZeroMQHandler(self.publisher, self.queue)
+        self.handler = ZeroMQHandler(self.publisher, self.queue,
+                peer_limiter=peer_limiter, sender_limiter=sender_limiter,
+                spool_threshold=self._spool_threshold,
+                spool_dir=self._spool_dir,
+                archive=self.archive,
+                structured=self._publish_format == 'structured')
+
+        # aiosmtpd advertises the size limit with the SIZE extension
+        # and stops buffering DATA as soon as the limit is exceeded
+        smtp_kwargs = {}
+        if self._max_message_size is not None:
+            smtp_kwargs['data_size_limit'] = self._max_message_size
+
         self.controller = Controller(self.handler,
-                hostname=self._mail_host, port=self._mail_port)
+                hostname=self._mail_host, port=self._mail_port,
+                **smtp_kwargs)
 
         self.controller.start()
 
 
-    def stop(self):
+    async def drain(self, timeout):
+
+        # stop listening for new SMTP sessions,
+        # sessions that are already open are drained
+        self.controller.server.close()
+
+        return await self.handler.drain(timeout)
+
+
+    def stop(self, timeout=10):
+        """stop the server, giving in flight messages timeout seconds
+
+        New SMTP sessions are refused, and messages sent on open sessions
+        get a 421 response. Messages already being handled have until
+        the timeout to be published, after which they are dropped. The
+        publisher then lingers for whatever is left of the timeout, so
+        subscribers can receive published messages.
+
+        Returns a dict with the number of messages flushed, published
+        while draining, and dropped. Messages still queued in the
+        publisher when the linger expires are discarded by zmq, and
+        are not counted. If archiving is on, the archive is flushed
+        within the same timeout, and unarchived counts the published
+        messages that didn't make it into the archive.
+        """
+
+        deadline = time.monotonic() + timeout
+        published = self.handler.published
+
+        # drain the mail server
+        drain = asyncio.run_coroutine_threadsafe(
+                self.drain(timeout), self.controller.loop)
+        try:
+            dropped = drain.result(timeout + 1)
+        except concurrent.futures.TimeoutError:
+            dropped = self.handler.in_flight
+
+        flushed = self.handler.published - published
+
+        log.info('Stopping: flushed {0} messages, dropped {1} messages'
+                .format(flushed, dropped))
 
         # stop/reset the mail server
         self.controller.stop()
@@ -150,12 +675,24 @@ class MailQueueServer(object):
         # tear down the debug queue
         self.queue = None
 
-        # tear down the message queue
-        self.publisher.close()
+        # flush and close the archive, within what is left of the timeout
+        unarchived = 0
+        if self.archive is not None:
+            unarchived = self.archive.stop(
+                    max(0, deadline - time.monotonic()))
+            self.archive = None
+
+        # tear down the message queue, with a bounded linger so
+        # undelivered messages can't keep context.term() waiting
+        linger = max(0, int((deadline - time.monotonic()) * 1000))
+        self.publisher.close(linger=linger)
         self.publisher = None
         self.context.term()
         self.context = None
 
+        return {'flushed' : flushed, 'dropped' : dropped,
+                'unarchived' : unarchived}
+
 
     def __enter__(self):
 
@@ -178,9 +715,22 @@ async def amain(opts,loop):
     s = MailQueueServer(opts.mail_queue_host,
                         opts.mail_queue_port,
                         opts.mail_host,
-                        opts.mail_port)
+                        opts.mail_port,
+                        peer_rate=opts.peer_rate,
+                        peer_burst=opts.peer_burst,
+                        sender_rate=opts.sender_rate,
+                        sender_burst=opts.sender_burst,
+                        max_message_size=opts.max_message_size,
+                        spool_threshold=opts.spool_threshold,
+                        spool_dir=opts.spool_dir,
+                        archive_path=opts.archive_path,
+                        archive_format=opts.archive_format,
+                        archive_rotate=opts.archive_rotate,
+                        publish_format=opts.publish_format)
     s.start()
 
+    return s
+
 
 if __name__ == '__main__':
 
@@ -189,9 +739,10 @@ if __name__ == '__main__':
     opts = parse_arguments()
 
     loop = asyncio.get_event_loop()
-    loop.create_task(amain(opts,loop))
+    task = loop.create_task(amain(opts,loop))
 
     try: 
         loop.run_forever()
     except KeyboardInterrupt:
-        pass
+        if task.done() and task.exception() is None:
+            task.result().stop(opts.shutdown_timeout)
@@ -1,17 +1,30 @@
+import argparse
+import asyncio
 import email
+import glob
+import gzip
+import io
 import logging
 import os
 import pytest
 import queue
 import smtplib
+import threading
+import time
+import zmq
 
 from email.utils import COMMASPACE, formataddr
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-from mqserver import MailQueueServer
-from mqclient import MailQueueClient
+import mqenvelope
+import mqreplay
+
+from mqarchive import ArchiveWriter
+from aiosmtpd.smtp import Envelope, Session
+from mqserver import MailQueueServer, FairPublisher, RateLimiter, ZeroMQHandler
+from mqclient import MailQueueClient, MultiplexedMailQueueClient
 
 pytestmark = []
 
@@ -427,3 +440,1020 @@ class TestMailQueueClient(object):
             self.client.messages.get(timeout=QUEUE_GET_TIMEOUT)
 
 
+
+
+
+class TestMultiplexedMailQueueClient(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self, request, mqserver, sendmail):
+        """
+        """
+
+        self.server = mqserver
+        self.sendmail = sendmail
+
+        self.client = MultiplexedMailQueueClient(CLIENT_QUEUE_HOST, QUEUE_PORT)
+        request.addfinalizer(self.client.stop)
+
+
+    def test_route_by_recipient_domain_and_header(self):
+        """each matching rule gets a copy of the message"""
+
+        by_rcpt = self.client.add_rule("rcpt",
+                recipients=["Recipient2@example.com"])
+        by_domain = self.client.add_rule("domain", domains=["example.com"])
+        by_subject = self.client.add_rule("subject",
+                headers={"Subject": "^urgent"})
+        other = self.client.add_rule("other", recipients=["x@example.org"])
+        self.client.start()
+
+        fromaddr = "author@example.com"
+        toaddrs = ["recipient1@example.com", "recipient2@example.com"]
+        subject = "email subject"
+        body = "email body"
+
+        sent_msg = self.sendmail(fromaddr, toaddrs, subject, body)
+
+        for q in [by_rcpt, by_domain]:
+            msg_bytes = q.get(timeout=QUEUE_GET_TIMEOUT)
+            recv_msg = email.message_from_bytes(msg_bytes)
+            assert recv_msg['Subject'] == subject
+
+        for q in [by_subject, other]:
+            with pytest.raises(queue.Empty):
+                q.get(timeout=QUEUE_GET_TIMEOUT)
+
+
+    def test_route_by_header(self):
+        """header rules are matched against the message headers"""
+
+        by_subject = self.client.add_rule("subject",
+                domains=["example.com"], headers={"Subject": "^urgent"})
+        self.client.start()
+
+        self.sendmail("author@example.com", ["recipient@example.com"],
+                "urgent subject", "email body")
+
+        msg_bytes = by_subject.get(timeout=QUEUE_GET_TIMEOUT)
+        recv_msg = email.message_from_bytes(msg_bytes)
+        assert recv_msg['Subject'] == "urgent subject"
+
+
+class TestLargeMessages(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self, request, msgcmp):
+        """
+        """
+
+        self.server = MailQueueServer(SERVER_QUEUE_HOST, QUEUE_PORT + 2,
+                SMTP_HOST, SMTP_PORT + 2,
+                max_message_size=10000, spool_threshold=100)
+        self.server.store_emails = True
+        self.server.start()
+        request.addfinalizer(self.server.stop)
+
+        self.msgcmp = msgcmp
+
+
+    def send(self, body, attachments=[]):
+
+        msg = MIMEMultipart()
+        msg['To'] = "recipient@example.com"
+        msg['From'] = "author@example.com"
+        msg['Subject'] = "email subject"
+        msg.attach(MIMEText(body))
+
+        for fname in attachments:
+            with open(fname,'rb') as f:
+                part = MIMEApplication(f.read(), Name=os.path.basename(fname))
+            msg.attach(part)
+
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT + 2)
+        try:
+            server.sendmail("author@example.com", ["recipient@example.com"],
+                    msg.as_string())
+        finally:
+            server.quit()
+
+        return msg
+
+
+    @pytest.mark.asyncio
+    async def test_spooled_message(self):
+        """messages over the spool threshold are published unchanged"""
+
+        sent_msg = self.send("email body",
+                [os.path.join(ATTACHMENTS_DIR,'hello.tgz')])
+
+        msg_bytes = await self.server.queue.get()
+        self.server.queue.task_done()
+
+        recv_msg = email.message_from_bytes(msg_bytes)
+
+        assert recv_msg['X-MailFrom'] == "author@example.com"
+        assert recv_msg['X-RcptTo'] == "recipient@example.com"
+        self.msgcmp(sent_msg, recv_msg)
+
+
+    async def handle(self, raw, spool_threshold, archive=None):
+        """run a message through a ZeroMQHandler, return the published bytes"""
+
+        debug_queue = asyncio.Queue()
+        handler = ZeroMQHandler(FakePublisher(), debug_queue,
+                spool_threshold=spool_threshold, archive=archive)
+
+        session = Session(asyncio.get_running_loop())
+        session.peer = ('127.0.0.1', 12345)
+
+        envelope = Envelope()
+        envelope.mail_from = "author@example.com"
+        envelope.rcpt_tos = ["recipient@example.com"]
+        envelope.content = envelope.original_content = raw
+
+        assert await handler.handle_DATA(None, session, envelope) == '250 OK'
+
+        return debug_queue.get_nowait()
+
+
+    def make_raw(self):
+
+        msg = MIMEMultipart()
+        msg['To'] = "recipient@example.com"
+        msg['From'] = "author@example.com"
+        msg['Subject'] = "a long subject " * 10
+        msg.attach(MIMEText("email body\nFrom here\n"))
+        with open(os.path.join(ATTACHMENTS_DIR,'hello.tgz'),'rb') as f:
+            msg.attach(MIMEApplication(f.read(), Name='hello.tgz'))
+
+        # messages arrive over SMTP with CRLF line endings
+        return msg.as_bytes().replace(b"\n", b"\r\n")
+
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("raw", [
+        None,
+        # a line in the header block that isn't a header
+        b"Subject: hi\r\nnot a header line\r\n\r\nbody\r\n",
+        b"Subject : hi\r\nTo: recipient@example.com\r\n\r\nbody\r\n",
+        # lone carriage returns, in the body and in the header block
+        b"Subject: hi\r\n\r\nline 1\rline 2\r\n\r\r\n",
+        b"Subject: hi\r\n\r\nbody\r",
+        b"Subject: hi\rTo: recipient@example.com\r\n\r\nbody\r\n",
+        # no header block at all
+        b"\r\nbody only\r\n",
+    ])
+    async def test_spooled_matches_parsed(self, raw):
+        """spooled and parsed messages are published byte for byte the same"""
+
+        if raw is None:
+            raw = self.make_raw()
+
+        parsed = await self.handle(raw, spool_threshold=None)
+        spooled = await self.handle(raw, spool_threshold=0)
+
+        assert b"\r" not in spooled
+        assert spooled == parsed
+
+
+    @pytest.mark.asyncio
+    async def test_spooled_archive(self, tmp_path):
+        """spooled messages are archived from the spool file"""
+
+        archive = ArchiveWriter(str(tmp_path), 'maildir')
+        archive.start()
+
+        published = await self.handle(self.make_raw(), spool_threshold=0,
+                archive=archive)
+
+        archive.stop()
+        assert archive.archived == 1
+
+        [path] = glob.glob(str(tmp_path / "archive-*" / "new" / "*.gz"))
+        with gzip.open(path, 'rb') as f:
+            assert f.read() == published
+
+
+    @pytest.mark.asyncio
+    async def test_archive_failure_accepts_message(self, tmp_path):
+        """a message that is published but not archived is still accepted"""
+
+        archive = ArchiveWriter(str(tmp_path))
+        def archive_failure(msg_bytes, sender=None):
+            raise OSError(24, "Too many open files")
+        archive.archive = archive_failure
+
+        for spool_threshold in (None, 0):
+            await self.handle(self.make_raw(), spool_threshold, archive=archive)
+
+        assert archive.dropped == 2
+
+
+    def test_max_message_size(self):
+        """messages over the size limit are refused"""
+
+        with pytest.raises((smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+            self.send("email body\n" * 2000)
+
+
+class TestArchiveWriter(object):
+
+    def make_message(self, subject, body):
+
+        msg = MIMEText(body)
+        msg['To'] = "recipient@example.com"
+        msg['From'] = "author@example.com"
+        msg['Subject'] = subject
+        return msg
+
+
+    def test_mbox_archive(self, tmp_path):
+        """messages are written to a gzip compressed mbox"""
+
+        writer = ArchiveWriter(str(tmp_path), 'mbox')
+        writer.start()
+
+        sent = [self.make_message("subject %d" % i, "From here\nbody %d" % i)
+                    for i in range(3)]
+        for msg in sent:
+            writer.archive(msg.as_bytes(), "author@example.com")
+
+        writer.stop()
+
+        assert writer.archived == 3
+        assert writer.dropped == 0
+
+        [path] = glob.glob(str(tmp_path / "archive-*.mbox.gz"))
+        with gzip.open(path, 'rb') as f:
+            entries = f.read().split(b'\n\nFrom ')
+
+        assert len(entries) == 3
+        assert entries[0].startswith(b'From author@example.com ')
+
+        recv_msg = email.message_from_bytes(entries[1].split(b'\n', 1)[1])
+        assert recv_msg['Subject'] == "subject 1"
+        assert recv_msg.get_payload() == ">From here\nbody 1"
+
+
+    def test_mbox_archive_from_file(self, tmp_path):
+        """messages spooled to files are streamed into the mbox"""
+
+        spool = tmp_path / "spool"
+        spool.write_bytes(self.make_message("subject", "From here").as_bytes())
+
+        writer = ArchiveWriter(str(tmp_path / "archive"), 'mbox')
+        writer.start()
+        f = open(str(spool), 'rb')
+        writer.archive(f, "author@example.com")
+        writer.stop()
+
+        assert f.closed
+        assert writer.archived == 1
+
+        [path] = glob.glob(str(tmp_path / "archive" / "archive-*.mbox.gz"))
+        with gzip.open(path, 'rb') as f:
+            entry = f.read()
+
+        assert entry.startswith(b'From author@example.com ')
+        assert entry.endswith(b'\n>From here\n\n')
+
+
+    def test_maildir_archive_rotation(self, tmp_path):
+        """a new Maildir is started when the current one is too big"""
+
+        writer = ArchiveWriter(str(tmp_path), 'maildir', max_bytes=1,
+                batch_size=1)
+        writer.start()
+
+        for i in range(2):
+            msg = self.make_message("subject %d" % i, "body %d" % i)
+            writer.archive(msg.as_bytes())
+
+        writer.stop()
+
+        paths = sorted(glob.glob(str(tmp_path / "archive-*" / "new" / "*.gz")))
+        assert len(paths) == 2
+        assert os.path.dirname(paths[0]) != os.path.dirname(paths[1])
+
+        subjects = set()
+        for path in paths:
+            with gzip.open(path, 'rb') as f:
+                subjects.add(email.message_from_bytes(f.read())['Subject'])
+        assert subjects == {"subject 0", "subject 1"}
+
+
+    def test_stop_timeout(self, tmp_path):
+        """stop() gives up on queued messages after the timeout"""
+
+        writer = ArchiveWriter(str(tmp_path), batch_size=1)
+
+        # make writing slow, so messages are still queued during stop()
+        write_batch = writer.write_batch
+        def slow_write_batch(batch):
+            time.sleep(0.5)
+            write_batch(batch)
+        writer.write_batch = slow_write_batch
+
+        writer.start()
+        for i in range(5):
+            writer.archive(b"message %d" % i)
+
+        started = time.monotonic()
+        unarchived = writer.stop(timeout=0.2)
+        assert time.monotonic() - started < 1
+
+        assert unarchived == 4
+        assert writer.dropped == 0
+
+
+    def test_archive_full_queue(self, tmp_path):
+        """archive() drops messages instead of blocking"""
+
+        writer = ArchiveWriter(str(tmp_path), max_queue=1)
+
+        writer.archive(b"message 1")
+        writer.archive(b"message 2")
+
+        assert writer.dropped == 1
+
+
+    def test_archive_too_many_files(self, tmp_path):
+        """only max_files spooled messages are queued at once"""
+
+        spool = tmp_path / "spool"
+        spool.write_bytes(b"message")
+
+        writer = ArchiveWriter(str(tmp_path / "archive"), max_files=1)
+
+        files = [open(str(spool), 'rb') for i in range(3)]
+        for f in files:
+            writer.archive(f)
+        writer.archive(b"message")
+
+        assert [f.closed for f in files] == [False, True, True]
+        assert writer.dropped == 2
+
+        # once the queued file is written, another one can be queued
+        writer.start()
+        writer.stop()
+        assert files[0].closed
+
+        f = open(str(spool), 'rb')
+        writer.archive(f)
+        assert writer.dropped == 2
+        writer.release(f)
+
+
+class TestReplay(object):
+
+    def test_capture_round_trip(self):
+        """records read back with their timing and frames"""
+
+        f = io.BytesIO()
+        f.write(mqreplay.MAGIC)
+        mqreplay.write_record(f, 0, [b"a@example.com", b"message 1"])
+        mqreplay.write_record(f, 1500, [b"b@example.com", b""])
+
+        f.seek(0)
+        assert list(mqreplay.read_records(f)) == [
+                (0, [b"a@example.com", b"message 1"]),
+                (1500, [b"b@example.com", b""])]
+
+
+    def test_truncated_capture(self):
+        """a record cut short at the end of a capture is skipped"""
+
+        f = io.BytesIO()
+        f.write(mqreplay.MAGIC)
+        mqreplay.write_record(f, 0, [b"a@example.com", b"message 1"])
+        mqreplay.write_record(f, 1500, [b"b@example.com", b"message 2"])
+        data = f.getvalue()
+
+        for cut in [1, mqreplay.RECORD_HEADER.size + 2, len(b"message 2")]:
+            records = list(mqreplay.read_records(io.BytesIO(data[:-cut])))
+            assert records == [(0, [b"a@example.com", b"message 1"])]
+
+
+    def test_replay_speed(self):
+        """replay keeps the recorded timing, scaled by speed"""
+
+        f = io.BytesIO()
+        f.write(mqreplay.MAGIC)
+        for i in range(3):
+            mqreplay.write_record(f, i * 100000000, [b"to", b"%d" % i])
+
+        class Publisher(object):
+            def __init__(self):
+                self.sent = []
+            def send_multipart(self, frames):
+                self.sent.append(frames)
+
+        publisher = Publisher()
+
+        f.seek(0)
+        started = time.monotonic()
+        assert mqreplay.replay(publisher, f, speed=2.0) == 3
+        elapsed = time.monotonic() - started
+
+        assert 0.1 <= elapsed < 0.5
+        assert [frames[1] for frames in publisher.sent] == [b"0", b"1", b"2"]
+
+
+    def test_record_and_replay(self, mqserver, sendmail, tmp_path):
+        """a recorded stream replays to mail queue clients"""
+
+        capture = str(tmp_path / "capture.gz")
+        context = zmq.Context()
+
+        subscriber = mqreplay.make_subscriber(context,
+                "tcp://{0}:{1}".format(CLIENT_QUEUE_HOST, QUEUE_PORT))
+
+        with mqreplay.open_capture(capture, 'wb') as f:
+            recorder = threading.Thread(target=mqreplay.record,
+                    args=(subscriber, f, 1, 10))
+            recorder.start()
+            time.sleep(0.5)
+            sent_msg = sendmail("author@example.com",
+                    ["recipient@example.com"], "replayed subject", "email body")
+            recorder.join()
+
+        subscriber.close()
+
+        publisher = mqreplay.make_publisher(context,
+                "tcp://{0}:{1}".format(SERVER_QUEUE_HOST, QUEUE_PORT + 3))
+
+        client = MailQueueClient(CLIENT_QUEUE_HOST, QUEUE_PORT + 3,
+                "recipient@example.com")
+        client.start()
+
+        try:
+            time.sleep(0.5)
+            with mqreplay.open_capture(capture, 'rb') as f:
+                assert mqreplay.replay(publisher, f, speed=0) == 1
+
+            msg_bytes = client.messages.get(timeout=QUEUE_GET_TIMEOUT)
+            recv_msg = email.message_from_bytes(msg_bytes)
+            assert recv_msg['Subject'] == "replayed subject"
+        finally:
+            client.stop()
+            publisher.close()
+            context.term()
+
+
+    def test_replay_max_speed_keeps_messages(self):
+        """a burst larger than the default high water marks is not dropped"""
+
+        count = 5000
+
+        f = io.BytesIO()
+        f.write(mqreplay.MAGIC)
+        for i in range(count):
+            mqreplay.write_record(f, 0, [b"to", b"x" * 20480])
+        f.seek(0)
+
+        context = zmq.Context()
+        uri = "tcp://{0}:{1}".format(SERVER_QUEUE_HOST, QUEUE_PORT + 6)
+        publisher = mqreplay.make_publisher(context, uri)
+        subscriber = mqreplay.make_subscriber(context, uri)
+
+        try:
+            time.sleep(0.5)
+
+            # the subscriber doesn't read until the whole burst is sent
+            assert mqreplay.replay(publisher, f, speed=0) == count
+
+            received = 0
+            while subscriber.poll(QUEUE_GET_TIMEOUT * 1000):
+                subscriber.recv_multipart()
+                received += 1
+                if received == count:
+                    break
+
+            assert received == count
+        finally:
+            subscriber.close()
+            publisher.close(linger=0)
+            context.term()
+
+
+    def test_main_failure_returns(self, tmp_path):
+        """main() returns instead of hanging when it fails"""
+
+        capture = tmp_path / "capture"
+        capture.write_bytes(b"not a capture")
+
+        replay_opts = argparse.Namespace(command="replay",
+                mail_queue_host=SERVER_QUEUE_HOST,
+                mail_queue_port=QUEUE_PORT + 8,
+                speed=0, wait=0, hwm=0, capture=str(capture))
+
+        record_opts = argparse.Namespace(command="record",
+                mail_queue_host=CLIENT_QUEUE_HOST,
+                mail_queue_port=QUEUE_PORT + 8,
+                filter_pattern="", count=None, duration=None, hwm=0,
+                capture=str(tmp_path / "missing" / "capture"))
+
+        for opts, error in ((replay_opts, Exception),
+                (record_opts, FileNotFoundError)):
+
+            errors = []
+            def run():
+                try:
+                    mqreplay.main(opts)
+                except Exception as e:
+                    errors.append(e)
+
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+            thread.join(5)
+
+            assert not thread.is_alive()
+            [e] = errors
+            assert isinstance(e, error)
+
+
+class TestStructuredMessages(object):
+
+    def make_message(self):
+
+        msg = MIMEMultipart()
+        msg['To'] = "recipient@example.com"
+        msg['From'] = "author@example.com"
+        msg['Subject'] = "=?utf-8?q?caf=C3=A9?="
+        msg['X-RcptTo'] = "recipient@example.com, other@example.com"
+        msg.attach(MIMEText("email body"))
+
+        fname = os.path.join(ATTACHMENTS_DIR,'hello.tgz')
+        with open(fname,'rb') as f:
+            part = MIMEApplication(f.read(), Name=os.path.basename(fname))
+        part['Content-Disposition'] = \
+            'attachment; filename="%s"' % os.path.basename(fname)
+        msg.attach(part)
+
+        return msg
+
+
+    @pytest.mark.parametrize("linesep", ["\n", "\r\n"])
+    def test_describe(self, linesep):
+        """the part table points at the raw bytes of each part"""
+
+        sent_msg = self.make_message()
+        raw = sent_msg.as_bytes().replace(b"\n", linesep.encode())
+
+        message = mqenvelope.StructuredMessage(raw)
+
+        assert message.rcpt_tos == ["recipient@example.com", "other@example.com"]
+        assert message.header("subject") == "caf\u00e9"
+
+        assert [part['path'] for part in message.parts] == ["", "1", "2"]
+        assert message.parts[0]['content_type'] == "multipart/mixed"
+
+        text, attachment = message.parts[1:]
+        assert message.part_payload(text) == b"email body"
+        assert message.attachments() == [attachment]
+        assert attachment['filename'] == "hello.tgz"
+
+        with open(os.path.join(ATTACHMENTS_DIR,'hello.tgz'), 'rb') as f:
+            assert message.part_payload(attachment) == f.read()
+
+
+    def test_header_rules_match_both_formats(self):
+        """header rules match the same with and without server headers"""
+
+        client = MultiplexedMailQueueClient(CLIENT_QUEUE_HOST, QUEUE_PORT)
+        urgent = client.add_rule("urgent",
+                headers={"Subject": "^urgent caf\u00e9$"})
+        folded = client.add_rule("folded", headers={"X-Long": "^one two$"})
+        other = client.add_rule("other", headers={"Subject": "^other"})
+
+        raw = (b"Subject: =?utf-8?q?urgent_caf=C3=A9?=\r\n"
+               b"X-Long: one\r\n two\r\n"
+               b"\r\n"
+               b"email body\r\n")
+
+        for meta in (None, mqenvelope.pack(raw)):
+            client.handle_message(b"recipient@example.com", raw, meta)
+            assert urgent.get_nowait() == raw
+            assert folded.get_nowait() == raw
+            assert other.empty()
+
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("spool_threshold", [None, 0])
+    async def test_structured_envelope_not_forged(self, spool_threshold):
+        """the structured envelope comes from SMTP, not from the headers"""
+
+        publisher = FakePublisher()
+        debug_queue = asyncio.Queue()
+        handler = ZeroMQHandler(publisher, debug_queue, structured=True,
+                spool_threshold=spool_threshold)
+
+        session = Session(asyncio.get_running_loop())
+        session.peer = ('127.0.0.1', 12345)
+
+        envelope = Envelope()
+        envelope.mail_from = "real@example.com"
+        envelope.rcpt_tos = ["recipient@example.com"]
+        envelope.content = envelope.original_content = (
+                b"X-Peer: 10.0.0.1\r\n"
+                b"X-MailFrom: forged@example.com\r\n"
+                b"X-RcptTo: victim@example.com\r\n"
+                b"Subject: hi\r\n"
+                b"\r\n"
+                b"email body\r\n")
+
+        assert await handler.handle_DATA(None, session, envelope) == '250 OK'
+
+        # spooled messages are sent from a memory map, which is
+        # closed by now, the debug queue has a copy
+        [(tos, msg_bytes, meta)] = publisher.sent
+        raw = debug_queue.get_nowait()
+        message = mqenvelope.StructuredMessage.from_frames(raw, meta)
+
+        assert tos == b"recipient@example.com"
+        assert message.peer == "('127.0.0.1', 12345)"
+        assert message.mail_from == "real@example.com"
+        assert message.rcpt_tos == ["recipient@example.com"]
+
+        # clients describing the message use the headers the server added
+        message = mqenvelope.StructuredMessage(raw)
+        assert message.mail_from == "real@example.com"
+        assert message.rcpt_tos == ["recipient@example.com"]
+
+
+    def test_structured_frame_without_msgpack(self, monkeypatch):
+        """clients without msgpack ignore the structured frame"""
+
+        raw = self.make_message().as_bytes()
+        meta = mqenvelope.pack(raw)
+
+        monkeypatch.setattr(mqenvelope, "msgpack", None)
+
+        client = MultiplexedMailQueueClient(CLIENT_QUEUE_HOST, QUEUE_PORT)
+        q = client.add_rule("subject", headers={"Subject": "caf"})
+        client.handle_message(b"recipient@example.com", raw, meta)
+        assert q.get_nowait() == raw
+
+        client = MailQueueClient(CLIENT_QUEUE_HOST, QUEUE_PORT, structured=True)
+        client.handle_message(b"recipient@example.com", raw, meta)
+        message = client.messages.get_nowait()
+        assert message.header("Subject") == "caf\u00e9"
+
+
+    def test_bad_message_keeps_client_running(self):
+        """a message that fails to be handled doesn't stop the client"""
+
+        context = zmq.Context()
+        uri = "tcp://{0}:{1}".format(SERVER_QUEUE_HOST, QUEUE_PORT + 7)
+        publisher = context.socket(zmq.PUB)
+        publisher.bind(uri)
+
+        client = MailQueueClient(CLIENT_QUEUE_HOST, QUEUE_PORT + 7)
+        client.start()
+
+        try:
+            time.sleep(0.5)
+
+            # a single frame message is missing the message body
+            publisher.send_multipart([b"recipient@example.com"])
+            publisher.send_multipart([b"recipient@example.com", b"message"])
+
+            assert client.messages.get(timeout=QUEUE_GET_TIMEOUT) == b"message"
+        finally:
+            client.stop()
+            publisher.close(linger=0)
+            context.term()
+
+
+    @pytest.mark.asyncio
+    async def test_describe_large_message(self):
+        """large messages are described off the event loop"""
+
+        msg = self.make_message()
+        msg.attach(MIMEApplication(b"x" * 200000, Name="large.bin"))
+        raw = msg.as_bytes()
+
+        publisher = FakePublisher()
+        handler = ZeroMQHandler(publisher, structured=True)
+        await handler.publish(b"recipient@example.com", raw,
+                "author@example.com")
+
+        [(tos, msg_bytes, meta)] = publisher.sent
+        envelope = mqenvelope.unpack(meta)
+        assert [part['filename'] for part in envelope['parts']] == \
+                [None, None, "hello.tgz", "large.bin"]
+
+
+    def test_structured_publish(self, request):
+        """clients receive the envelope the server described"""
+
+        server = MailQueueServer(SERVER_QUEUE_HOST, QUEUE_PORT + 4,
+                SMTP_HOST, SMTP_PORT + 4, publish_format='structured')
+        server.start()
+        request.addfinalizer(server.stop)
+
+        structured = MailQueueClient(CLIENT_QUEUE_HOST, QUEUE_PORT + 4,
+                structured=True)
+        structured.start()
+        request.addfinalizer(structured.stop)
+
+        raw = MailQueueClient(CLIENT_QUEUE_HOST, QUEUE_PORT + 4)
+        raw.start()
+        request.addfinalizer(raw.stop)
+
+        time.sleep(0.5)
+
+        sent_msg = self.make_message()
+        del sent_msg['X-RcptTo']
+
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT + 4)
+        try:
+            smtp.sendmail("author@example.com", ["recipient@example.com"],
+                    sent_msg.as_string())
+        finally:
+            smtp.quit()
+
+        message = structured.messages.get(timeout=QUEUE_GET_TIMEOUT)
+        assert message.mail_from == "author@example.com"
+        assert message.rcpt_tos == ["recipient@example.com"]
+        [attachment] = message.attachments()
+        assert message.part_payload(attachment) == \
+                sent_msg.get_payload()[1].get_payload(decode=True)
+
+        # clients not asking for the structured format get bytes
+        msg_bytes = raw.messages.get(timeout=QUEUE_GET_TIMEOUT)
+        assert msg_bytes == message.raw
+
+
+class SlowPublisher(object):
+
+    def __init__(self, publisher, delay):
+        self.publisher = publisher
+        self.delay = delay
+
+    async def send_multipart(self, frames):
+        await asyncio.sleep(self.delay)
+        await self.publisher.send_multipart(frames)
+
+
+class TestGracefulShutdown(object):
+
+    def start_server(self, delay):
+
+        server = MailQueueServer(SERVER_QUEUE_HOST, QUEUE_PORT + 5,
+                SMTP_HOST, SMTP_PORT + 5)
+        server.start()
+
+        # make publishing slow, so messages are in flight during stop()
+        fair = server.handler._publisher
+        fair._publisher = SlowPublisher(fair._publisher, delay)
+
+        return server
+
+
+    def send_in_background(self):
+
+        results = []
+
+        def send():
+            try:
+                smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT + 5)
+                smtp.sendmail("author@example.com", ["recipient@example.com"],
+                        MIMEText("email body").as_string())
+                results.append("sent")
+            except Exception as e:
+                results.append(e)
+
+        thread = threading.Thread(target=send)
+        thread.start()
+
+        # wait for the message to reach the handler
+        time.sleep(0.3)
+
+        return thread, results
+
+
+    def test_stop_flushes_in_flight_messages(self):
+        """stop() waits for in flight messages to be published"""
+
+        server = self.start_server(delay=0.5)
+        thread, results = self.send_in_background()
+
+        assert server.stop(timeout=5) == {'flushed' : 1, 'dropped' : 0,
+                'unarchived' : 0}
+
+        thread.join()
+        assert results == ["sent"]
+
+
+    def test_stop_timeout_drops_messages(self):
+        """stop() gives up on in flight messages after the timeout"""
+
+        server = self.start_server(delay=30)
+        thread, results = self.send_in_background()
+
+        started = time.monotonic()
+        assert server.stop(timeout=0.5) == {'flushed' : 0, 'dropped' : 1,
+                'unarchived' : 0}
+        assert time.monotonic() - started < 5
+
+        thread.join()
+        assert results != ["sent"]
+
+
+    def test_stop_refuses_new_messages(self):
+        """open sessions get a 421 and new connections are refused"""
+
+        server = self.start_server(delay=1)
+
+        # a session opened before stop(), which sends its message after
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT + 5)
+        smtp.ehlo()
+
+        thread, results = self.send_in_background()
+
+        stopping = threading.Thread(target=server.stop, args=(5,))
+        stopping.start()
+        time.sleep(0.2)
+
+        try:
+            with pytest.raises(smtplib.SMTPDataError) as e:
+                smtp.sendmail("author@example.com", ["recipient@example.com"],
+                        MIMEText("email body").as_string())
+            assert e.value.smtp_code == 421
+
+            with pytest.raises(OSError):
+                smtplib.SMTP(SMTP_HOST, SMTP_PORT + 5)
+        finally:
+            smtp.close()
+            stopping.join()
+            thread.join()
+
+        assert results == ["sent"]
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakePublisher(object):
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_multipart(self, frames):
+        # yield to the event loop, like a backlogged socket would
+        await asyncio.sleep(0)
+        self.sent.append(frames)
+
+
+class TestRateLimiting(object):
+
+    def test_rate_limiter_burst(self):
+        """keys get burst messages, then are limited until refilled"""
+
+        clock = FakeClock()
+        limiter = RateLimiter(1, burst=2, clock=clock)
+
+        assert limiter.allow("a") is True
+        assert limiter.allow("a") is True
+        assert limiter.allow("a") is False
+
+        # other keys have their own bucket
+        assert limiter.allow("b") is True
+
+        clock.now += 1
+        assert limiter.allow("a") is True
+        assert limiter.allow("a") is False
+
+
+    def test_rate_limiter_max_keys(self):
+        """least recently used buckets are evicted"""
+
+        limiter = RateLimiter(1, burst=1, max_keys=2, clock=FakeClock())
+
+        assert limiter.allow("a") is True
+        assert limiter.allow("b") is True
+        assert limiter.allow("c") is True
+
+        # "a" was evicted and starts with a full bucket again
+        assert limiter.allow("a") is True
+        assert limiter.allow("c") is False
+
+
+    def test_rate_limiter_bad_burst(self):
+        """a burst below one would reject every message"""
+
+        with pytest.raises(ValueError):
+            RateLimiter(1, burst=0)
+
+
+    def test_sender_limit_keeps_peer_tokens(self):
+        """messages rejected by the sender limit don't use peer tokens"""
+
+        server = MailQueueServer(SERVER_QUEUE_HOST, QUEUE_PORT + 1,
+                SMTP_HOST, SMTP_PORT + 1, peer_rate=0.01, peer_burst=2,
+                sender_rate=0.01, sender_burst=1)
+        server.start()
+
+        try:
+            msg = MIMEText("email body")
+            smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT + 1)
+            try:
+                smtp.sendmail("noisy@example.com",
+                        ["recipient@example.com"], msg.as_string())
+
+                # rejected by the sender limit
+                with pytest.raises(smtplib.SMTPDataError) as e:
+                    smtp.sendmail("noisy@example.com",
+                            ["recipient@example.com"], msg.as_string())
+                assert b"Sender" in e.value.smtp_error
+
+                # the peer still has a token left
+                smtp.sendmail("quiet@example.com",
+                        ["recipient@example.com"], msg.as_string())
+            finally:
+                smtp.quit()
+        finally:
+            server.stop()
+
+
+    @pytest.mark.asyncio
+    async def test_fair_publisher_round_robin(self):
+        """a backlogged sender should not hold up other senders"""
+
+        publisher = FakePublisher()
+        fair = FairPublisher(publisher)
+
+        sends = [fair.send_multipart([b"noisy", b"%d" % i], sender="noisy")
+                    for i in range(3)]
+        sends.append(fair.send_multipart([b"quiet", b"0"], sender="quiet"))
+
+        await asyncio.gather(*sends)
+
+        assert [frames[0] for frames in publisher.sent] == \
+                [b"noisy", b"quiet", b"noisy", b"noisy"]
+        assert fair.backlog == 0
+
+
+    @pytest.mark.asyncio
+    async def test_publish_uses_smtp_envelope(self):
+        """forged X-MailFrom and X-RcptTo headers are not used for publishing"""
+
+        handler = ZeroMQHandler(FakePublisher())
+
+        sent = []
+        async def send_multipart(frames, sender=None):
+            sent.append((frames[0], sender))
+        handler._publisher.send_multipart = send_multipart
+
+        session = Session(asyncio.get_running_loop())
+        session.peer = ('127.0.0.1', 12345)
+
+        envelope = Envelope()
+        envelope.mail_from = "real@example.com"
+        envelope.rcpt_tos = ["recipient@example.com"]
+        envelope.content = envelope.original_content = (
+                b"X-MailFrom: forged@example.com\r\n"
+                b"X-RcptTo: victim@example.com\r\n"
+                b"Subject: hi\r\n"
+                b"\r\n"
+                b"email body\r\n")
+
+        assert await handler.handle_DATA(None, session, envelope) == '250 OK'
+        assert sent == [(b"recipient@example.com", "real@example.com")]
+
+
+    def test_sender_rate_limit_tempfail(self):
+        """messages over the sender limit get a 4xx response"""
+
+        server = MailQueueServer(SERVER_QUEUE_HOST, QUEUE_PORT + 1,
+                SMTP_HOST, SMTP_PORT + 1, sender_rate=0.01, sender_burst=1)
+        server.start()
+
+        try:
+            msg = MIMEText("email body")
+            smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT + 1)
+            try:
+                smtp.sendmail("noisy@example.com",
+                        ["recipient@example.com"], msg.as_string())
+
+                with pytest.raises(smtplib.SMTPDataError) as e:
+                    smtp.sendmail("noisy@example.com",
+                            ["recipient@example.com"], msg.as_string())
+                assert e.value.smtp_code == 451
+
+                # other senders are not affected
+                smtp.sendmail("quiet@example.com",
+                        ["recipient@example.com"], msg.as_string())
+            finally:
+                smtp.quit()
+        finally:
+            server.stop()